@@ -8,10 +8,22 @@ OBC – Lager & Försäljning  (ENDAST Store 1)
 • RESET_DATABASE=true kan nollställa tabellerna vid behov.
 """
 # --------------------------------------------------------------------------- #
-import os, re, time, json, math, requests, gspread, psycopg2
+import bisect, io, os, re, time, json, math, contextlib, functools, threading
+import requests, gspread
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 from oauth2client.service_account import ServiceAccountCredentials
-from typing import Dict, List
+from psycopg2.extras import execute_values
+from psycopg2.pool import SimpleConnectionPool
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson                       # valfritt: snabbare avkodning av Shopify-svaren
+except ImportError:
+    orjson = None
+from typing import Dict, Iterator, List, Optional, Tuple
 # --------------------------------------------------------------------------- #
 #                              Miljövariabler                                 #
 # --------------------------------------------------------------------------- #
@@ -43,121 +55,405 @@ sales_sheet_US = client.open("OBC lager").worksheet("Blad3")
 # --------------------------------------------------------------------------- #
 #                               PostgreSQL                                    #
 # --------------------------------------------------------------------------- #
+_pool = None
+
+def _pg_pool() -> SimpleConnectionPool:
+    global _pool
+    if _pool is None:
+        _pool = SimpleConnectionPool(1, 4, DATABASE_URL, sslmode="require")
+    return _pool
+
+@contextlib.contextmanager
 def pg_conn():
-    return psycopg2.connect(DATABASE_URL, sslmode="require")
+    # En SSL-anslutning för hela körningen i stället för en per hjälpfunktion
+    conn = _pg_pool().getconn()
+    try:
+        with conn:                      # commit vid lyckat block, rollback vid undantag
+            yield conn
+    finally:
+        _pg_pool().putconn(conn)
+
+def close_pg_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.closeall()
+        _pool = None
+
+RESET_SQL = "DROP TABLE IF EXISTS processed_orders;"
+INIT_SQL  = """
+    CREATE TABLE IF NOT EXISTS processed_orders (
+        order_id BIGINT PRIMARY KEY,
+        processed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    -- Migrering: äldre tabeller har order_id TEXT / processed_at TIMESTAMP
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = current_schema()
+                     AND table_name = 'processed_orders'
+                     AND column_name = 'order_id' AND data_type = 'text') THEN
+            ALTER TABLE processed_orders
+                ALTER COLUMN order_id TYPE BIGINT USING order_id::BIGINT,
+                ALTER COLUMN processed_at TYPE TIMESTAMPTZ USING processed_at AT TIME ZONE 'UTC';
+        END IF;
+    END $$;
+"""
 
 def init_tables() -> None:
+    # Ev. reset + CREATE skickas som ett enda anrop (en nätverksrunda)
     with pg_conn() as conn, conn.cursor() as cur:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS processed_orders (
-                order_id TEXT PRIMARY KEY,
-                processed_at TIMESTAMP NOT NULL DEFAULT NOW()
-            );
-        """)
+        cur.execute((RESET_SQL if RESET_DB else "") + INIT_SQL)
         conn.commit()
+    if RESET_DB:
+        print("[DB] Tabeller rensade (RESET_DATABASE=true).")
 
-def reset_database() -> None:
-    if not RESET_DB:
-        return
-    with pg_conn() as conn, conn.cursor() as cur:
-        cur.execute("DROP TABLE IF EXISTS processed_orders;")
-        conn.commit()
-    print("[DB] Tabeller rensade (RESET_DATABASE=true).")
-
-def processed_order_ids() -> set:
-    with pg_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT order_id FROM processed_orders;")
-        return {row[0] for row in cur.fetchall()}
+# execute_values skickar en INSERT per sida; COPY-vägen kostar alltid tre anrop
+# (CREATE TEMP, COPY, INSERT … SELECT) och vinner så fort det blir fler sidor än så.
+INSERT_PAGE_SIZE = 1000
+COPY_THRESHOLD   = 3 * INSERT_PAGE_SIZE
 
-def save_processed(ids: List[str]) -> None:
+# Registrerar order-id:n och returnerar de som inte fanns sedan tidigare, dvs. de
+# som ska behandlas. Ersätter att läsa in hela processed_orders varje körning.
+def save_processed(ids: List[int]) -> set:
     if not ids:
-        return
+        return set()
     with pg_conn() as conn, conn.cursor() as cur:
-        cur.executemany(
-            "INSERT INTO processed_orders (order_id) VALUES (%s) ON CONFLICT DO NOTHING;",
-            [(oid,) for oid in ids],
-        )
+        if len(ids) > COPY_THRESHOLD:
+            cur.execute("CREATE TEMP TABLE tmp_order_ids (order_id BIGINT) ON COMMIT DROP;")
+            cur.copy_expert("COPY tmp_order_ids (order_id) FROM STDIN",
+                            io.StringIO("\n".join(map(str, ids))))
+            cur.execute("""
+                INSERT INTO processed_orders (order_id)
+                SELECT DISTINCT order_id FROM tmp_order_ids
+                ON CONFLICT DO NOTHING RETURNING order_id;
+            """)
+            rows = cur.fetchall()
+        else:
+            rows = execute_values(
+                cur,
+                "INSERT INTO processed_orders (order_id) VALUES %s "
+                "ON CONFLICT DO NOTHING RETURNING order_id;",
+                [(oid,) for oid in ids],
+                page_size=INSERT_PAGE_SIZE,
+                fetch=True,
+            )
         conn.commit()
+    return {row[0] for row in rows}
 # --------------------------------------------------------------------------- #
 #                               Hjälpfunktioner                               #
 # --------------------------------------------------------------------------- #
+# Token-bucket för Sheets-kvoten (60 anrop/min/användare): full fart tills
+# fönstret är fullt, först då väntar vi.
+SHEETS_QUOTA   = 60
+SHEETS_WINDOW  = 60.0
+_recent_calls: deque = deque()
+
+def _throttle() -> None:
+    now = time.monotonic()
+    while _recent_calls and now - _recent_calls[0] >= SHEETS_WINDOW:
+        _recent_calls.popleft()
+    if len(_recent_calls) >= SHEETS_QUOTA:
+        time.sleep(SHEETS_WINDOW - (now - _recent_calls[0]))
+    _recent_calls.append(time.monotonic())
+
+SHEETS_MAX_RETRIES        = 6
+SHEETS_RETRY_STATUS       = (429, 500, 502, 503, 504)   # läsningar: kvot + tillfälliga serverfel
+# En skrivning kan redan vara utförd när 5xx kommer – att försöka igen kan infoga
+# rader/kolumner två gånger. 429 betyder att anropet avvisades och är säkert att upprepa.
+SHEETS_WRITE_RETRY_STATUS = (429,)
+
+def _call_with_retry(retry_status, func, *args, **kwargs):
+    for attempt in range(SHEETS_MAX_RETRIES):
+        _throttle()
+        try:
+            return func(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if (e.response.status_code not in retry_status
+                    or attempt == SHEETS_MAX_RETRIES - 1):
+                raise
+            retry_after = e.response.headers.get("Retry-After", "")
+            delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+            print(f"[Google] {e.response.status_code} – väntar {delay} s …")
+            time.sleep(delay)
+
 def safe_api_call(func, *args, **kwargs):
-    try:
-        res = func(*args, **kwargs)
-        time.sleep(2)
-        return res
-    except gspread.exceptions.APIError as e:
-        if e.response.status_code == 429:
-            print("[Google] 429 – väntar 60 s …")
-            time.sleep(60)
-            return safe_api_call(func, *args, **kwargs)
-        raise
+    # Läsningar och andra idempotenta anrop
+    return _call_with_retry(SHEETS_RETRY_STATUS, func, *args, **kwargs)
+
+def safe_write_call(func, *args, **kwargs):
+    # Skrivningar som inte tål att köras två gånger (append_rows, batch_update med infogningar)
+    return _call_with_retry(SHEETS_WRITE_RETRY_STATUS, func, *args, **kwargs)
+
+class SheetCache:
+    # Lokal kopia av ett blads värden – läses om först när vi själva har skrivit till bladet
+    def __init__(self, ws):
+        self.ws    = ws
+        self._vals = None
+
+    def values(self) -> List[List[str]]:
+        if self._vals is None:
+            self._vals = safe_api_call(self.ws.get_all_values)
+        return self._vals
+
+    def set_values(self, rows: List[List[str]]) -> None:
+        # batchGet kapar tomma celler i radslut – fyll ut som get_all_values gör
+        width = max(map(len, rows), default=0)
+        self._vals = [r + [""] * (width - len(r)) for r in rows]
+
+    def mark_dirty(self) -> None:
+        self._vals = None
+
+    def append_rows(self, rows, **kwargs) -> None:
+        # Lägg in raderna lokalt på den plats Sheets rapporterar, så slipper nästa
+        # läsare ladda ned hela bladet igen
+        res = safe_write_call(self.ws.append_rows, rows, **kwargs) or {}
+        m = _A1_ROW_RE.search(res.get("updates", {}).get("updatedRange", ""))
+        if self._vals is None or not m:
+            self.mark_dirty()
+            return
+        vals  = self._vals
+        width = len(vals[0]) if vals else 0
+        start = int(m.group(1)) - 1
+        for i, row in enumerate(rows, start):
+            text = [str(v) for v in row]
+            text += [""] * (width - len(text))
+            while len(vals) < i:
+                vals.append([""] * width)
+            if i < len(vals):
+                vals[i] = text
+            else:
+                vals.append(text)
+
+_A1_ROW_RE = re.compile(r"![A-Z]+(\d+)")
 
-def extract_perfume_number(text: str):
-    m = re.search(r"(\d{1,3}(?:\.\d+)?)\b", text)
+blad1 = SheetCache(sheet)
+blad2 = SheetCache(sales_sheet)
+blad3 = SheetCache(sales_sheet_US)
+
+def prefetch(*caches: SheetCache) -> None:
+    # Alla blad som ännu inte är lästa hämtas i ett enda values.batchGet
+    todo = [c for c in caches if c._vals is None]
+    if not todo:
+        return
+    res = safe_api_call(todo[0].ws.spreadsheet.values_batch_get,
+                        [f"'{c.ws.title}'" for c in todo])
+    for c, vr in zip(todo, res.get("valueRanges", [])):
+        c.set_values(vr.get("values", []))
+
+_PERFUME_RE = re.compile(r"(\d{1,3}(?:\.\d+)?)\b")
+_SAMPLE_RE  = re.compile(r"sample", re.IGNORECASE)
+_BUNDLE_RE  = re.compile(r"Fragrance Bundle")
+
+@functools.lru_cache(maxsize=4096)      # samma titlar/SKU:er återkommer i varje order
+def extract_perfume_number(text: Optional[str]):
+    if not text:
+        return None
+    m = _PERFUME_RE.search(text)
     return float(m.group(1)) if m else None
 
+@functools.lru_cache(maxsize=None)      # anropas per (datum, parfym) i log_sales
 def fmt_perfume(num: float) -> str:
     return str(int(num)) if math.isclose(num, round(num)) else str(num)
+
+# En gemensam Session: keep-alive mot Shopify i stället för ny TLS-handskakning per sida.
+# urllib3 sköter 5xx-omförsök med backoff. Retry-After ignoreras där: Shopify skickar den
+# som flyttal ("2.0"), vilket urllib3 avvisar med InvalidHeader – 429 hanteras i shopify_get.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=8,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504],
+                      respect_retry_after_header=False, raise_on_status=False),
+))
+
+SHOPIFY_CONCURRENCY = 4     # samtidiga anrop per butik inom Shopifys leaky bucket
+SHOPIFY_MAX_RETRIES = 6     # försök per anrop när Shopify svarar 429
+# Lager- och orderhämtningen har egna trådpooler som kan köra samtidigt – taket gäller
+# alla REST-anrop tillsammans
+_shopify_slots = threading.BoundedSemaphore(SHOPIFY_CONCURRENCY)
+
+# Shopify har sin egen leaky bucket – Googles kvot i safe_api_call gäller inte här
+def shopify_get(url: str, **kwargs) -> requests.Response:
+    for attempt in range(SHOPIFY_MAX_RETRIES):
+        with _shopify_slots:
+            r = SESSION.get(url, timeout=60, **kwargs)
+        if r.status_code != 429 or attempt == SHOPIFY_MAX_RETRIES - 1:
+            return r
+        try:
+            delay = float(r.headers.get("Retry-After", ""))
+        except ValueError:
+            delay = 2.0                 # Shopifys bucket fylls på med 2 anrop/s
+        print(f"[Shopify] 429 – väntar {delay} s …")
+        time.sleep(delay)
+
+def parse_json(content: bytes):
+    return orjson.loads(content) if orjson else json.loads(content)
+
+def next_page_url(r: requests.Response) -> Optional[str]:
+    # requests tolkar Link-headern (parse_header_links) åt oss
+    return r.links.get("next", {}).get("url")
+
+def shopify_graphql(domain: str, token: str, query: str, variables: Optional[dict] = None) -> dict:
+    r = SESSION.post(f"https://{domain}/admin/api/2023-07/graphql.json",
+                     headers={"X-Shopify-Access-Token": token},
+                     json={"query": query, "variables": variables or {}}, timeout=60)
+    if r.status_code != 200:
+        raise RuntimeError(f"Shopify GraphQL error {r.status_code}: {r.text}")
+    body = parse_json(r.content)
+    if body.get("errors"):
+        raise RuntimeError(f"Shopify GraphQL error: {body['errors']}")
+    return body["data"]
+
+BULK_POLL_SECONDS    = 2
+BULK_TIMEOUT_SECONDS = 600          # längre än så → ge upp och låt anroparen gå över till REST
+_bulk_lock = threading.Lock()       # API 2023-07 tillåter en bulk-query åt gången per butik
+
+def run_bulk_query(domain: str, token: str, query: str) -> Iterator[dict]:
+    # Bulk Operations: 1 mutation + pollning + 1 JSONL-nedladdning i stället för sidvis REST.
+    # Filen strömmas rad för rad, så hela nedladdningen ligger aldrig i minnet samtidigt.
+    with _bulk_lock:
+        url = _run_bulk_operation(domain, token, query)
+    if not url:                             # inga objekt matchade
+        return
+    with SESSION.get(url, stream=True, timeout=300) as r:
+        if r.status_code != 200:
+            raise RuntimeError(f"Bulk-nedladdning error {r.status_code}")
+        for line in r.iter_lines():
+            if line:
+                yield parse_json(line)
+
+def _run_bulk_operation(domain: str, token: str, query: str) -> Optional[str]:
+    started = shopify_graphql(domain, token, """
+        mutation($q: String!) {
+          bulkOperationRunQuery(query: $q) { bulkOperation { id } userErrors { message } }
+        }""", {"q": query})["bulkOperationRunQuery"]
+    if started["userErrors"]:
+        raise RuntimeError(f"Bulk-operation avvisad: {started['userErrors']}")
+    op_id = started["bulkOperation"]["id"]
+    try:
+        return _poll_bulk_operation(domain, token, op_id)
+    except BaseException:
+        # Avbryt vid timeout, THROTTLED, nätverksfel, Ctrl-C … – annars blockerar den
+        # kvarvarande operationen nästa bulk-query (och nästa körning) och tvingar fram REST
+        with contextlib.suppress(Exception):
+            shopify_graphql(domain, token, """
+                mutation($id: ID!) { bulkOperationCancel(id: $id) { userErrors { message } } }""",
+                            {"id": op_id})
+        raise
+
+def _poll_bulk_operation(domain: str, token: str, op_id: str) -> Optional[str]:
+    deadline = time.monotonic() + BULK_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        time.sleep(BULK_POLL_SECONDS)
+        op = shopify_graphql(domain, token,
+                             "{ currentBulkOperation { id status errorCode url } }")["currentBulkOperation"]
+        # None eller annat id: operationen har ersatts (t.ex. av en annan app)
+        if op is None or op["id"] != op_id:
+            raise RuntimeError("Bulk-operation försvann/ersattes under pollningen")
+        if op["status"] == "COMPLETED":
+            return op["url"]
+        if op["status"] in ("FAILED", "CANCELED", "EXPIRED"):
+            raise RuntimeError(f"Bulk-operation {op['status']} ({op['errorCode']})")
+    raise RuntimeError(f"Bulk-operation blev inte klar inom {BULK_TIMEOUT_SECONDS} s")
 # --------------------------------------------------------------------------- #
 #                    Shopify → lager (endast en location)                     #
 # --------------------------------------------------------------------------- #
+INVENTORY_BULK_QUERY = """
+{
+  productVariants {
+    edges { node {
+      sku
+      title
+      inventoryItem {
+        inventoryLevel(locationId: "gid://shopify/Location/%s") {
+          quantities(names: ["available"]) { name quantity }
+        }
+      }
+    } }
+  }
+}"""
+
 def fetch_shopify_inventory(domain: str, token: str, location_id: str) -> Dict[float, int]:
+    try:
+        inventory = fetch_inventory_bulk(domain, token, location_id)
+    except (RuntimeError, requests.RequestException, KeyError, ValueError) as e:
+        print(f"[Lager-sync] Bulk-hämtning misslyckades ({e}) – använder REST.")
+        inventory = fetch_inventory_rest(domain, token, location_id)
+    print(f"[Lager-sync] Hämtade {len(inventory)} parfymnummer från Shopify location {location_id}.")
+    return inventory
+
+def fetch_inventory_bulk(domain: str, token: str, location_id: str) -> Dict[float, int]:
+    inventory: Counter = Counter()
+    for v in run_bulk_query(domain, token, INVENTORY_BULK_QUERY % location_id):
+        pnr   = extract_perfume_number(v.get("sku") or v.get("title"))
+        level = (v.get("inventoryItem") or {}).get("inventoryLevel")
+        if pnr is None or not level:        # ingen lagernivå på vår location
+            continue
+        avail = sum(q["quantity"] or 0 for q in level["quantities"] if q["name"] == "available")
+        inventory[pnr] += int(avail)
+    return inventory
+
+def fetch_inventory_rest(domain: str, token: str, location_id: str) -> Dict[float, int]:
     base_v  = f"https://{domain}/admin/api/2023-07/variants.json"
     headers = {"X-Shopify-Access-Token": token}
     params  = {"limit": 250, "fields": "id,title,sku,inventory_item_id"}
     item_to_perf: Dict[int, float] = {}
     while True:
-        r = safe_api_call(requests.get, base_v, headers=headers, params=params)
+        r = shopify_get(base_v, headers=headers, params=params)
         if r.status_code != 200:
             raise RuntimeError(f"Shopify variants error {r.status_code}: {r.text}")
-        for v in r.json().get("variants", []):
-            pnr = extract_perfume_number(v.get("sku") or v.get("title", ""))
+        for v in parse_json(r.content).get("variants", []):
+            pnr = extract_perfume_number(v.get("sku") or v.get("title"))
             if pnr is not None:
                 item_to_perf[v["inventory_item_id"]] = pnr
-        next_url = None
-        for part in r.headers.get("Link", "").split(","):
-            if 'rel="next"' in part:
-                next_url = part[part.find("<")+1:part.find(">")]
-                break
+        next_url = next_page_url(r)
         if not next_url:
             break
         base_v, params = next_url, {}
     if not item_to_perf:
         return {}
 
-    inventory: Dict[float, int] = {}
-    items = list(item_to_perf.keys())
-    for i in range(0, len(items), 50):
-        sub = ",".join(map(str, items[i:i+50]))
-        url = f"https://{domain}/admin/api/2023-07/inventory_levels.json"
+    url = f"https://{domain}/admin/api/2023-07/inventory_levels.json"
+
+    def fetch_levels(chunk: List[int]) -> List[dict]:
         level_params = {
-            "inventory_item_ids": sub,
+            "inventory_item_ids": ",".join(map(str, chunk)),
             "location_ids": location_id,
             "limit": 250,
         }
-        r = safe_api_call(requests.get, url, headers=headers, params=level_params)
+        r = shopify_get(url, headers=headers, params=level_params)
         if r.status_code != 200:
             raise RuntimeError(f"Shopify inventory_levels error {r.status_code}: {r.text}")
-        for lv in r.json().get("inventory_levels", []):
-            p = item_to_perf.get(lv["inventory_item_id"])
-            if p is None:
-                continue
-            avail = lv.get("available") or 0
-            inventory[p] = inventory.get(p, 0) + int(avail)
-    print(f"[Lager-sync] Hämtade {len(inventory)} parfymnummer från Shopify location {location_id}.")
+        return parse_json(r.content).get("inventory_levels", [])
+
+    # 50-id-bitarna är oberoende av varandra – hämta dem parallellt
+    items  = list(item_to_perf.keys())
+    chunks = [items[i:i+50] for i in range(0, len(items), 50)]
+    inventory: Counter = Counter()
+    with ThreadPoolExecutor(max_workers=SHOPIFY_CONCURRENCY) as pool:
+        for levels in pool.map(fetch_levels, chunks):
+            for lv in levels:
+                p = item_to_perf.get(lv["inventory_item_id"])
+                if p is None:
+                    continue
+                inventory[p] += int(lv.get("available") or 0)
     return inventory
 
-def write_inventory_to_sheet(inv: Dict[float, int]) -> None:
-    vals     = safe_api_call(sheet.get_all_values)
-    p_to_row = {}
-    for i, r in enumerate(vals, 1):
-        if i == 1 or not r or not r[0]:
+def perfume_rows(vals: List[List[str]]) -> Dict[float, int]:
+    # parfymnummer (kolumn A) → radnummer i Blad1; rubrik och ogiltiga rader hoppas över
+    p_to_row: Dict[float, int] = {}
+    for i, r in enumerate(vals[1:], 2):
+        if not r or not r[0].strip():
             continue
         try:
             p_to_row[float(r[0])] = i
         except ValueError:
             continue
+    return p_to_row
+
+# Nya parfymer läggs till direkt; saldon för befintliga rader returneras som celler
+# och skrivs tillsammans med Sold/snitt i main().
+def write_inventory_to_sheet(inv: Dict[float, int]) -> List[gspread.Cell]:
+    p_to_row = perfume_rows(blad1.values())
 
     new_rows, updates = [], []
     for pnum, qty in inv.items():
@@ -167,18 +463,16 @@ def write_inventory_to_sheet(inv: Dict[float, int]) -> None:
             new_rows.append([fmt_perfume(pnum), qty, 0])
 
     if new_rows:
-        safe_api_call(sheet.append_rows, new_rows, value_input_option="USER_ENTERED")
+        blad1.append_rows(new_rows, value_input_option="USER_ENTERED")
         print(f"[Lager-sync] Lagt till {len(new_rows)} nya rader.")
-    if updates:
-        safe_api_call(sheet.update_cells, updates)
-        print(f"[Lager-sync] Uppdaterat lagersaldo för {len(updates)} rader.")
+    return updates
 # --------------------------------------------------------------------------- #
 #                Robust avläsning av “Sold:” (tål tomma rubriker)             #
 # --------------------------------------------------------------------------- #
-def read_sold_column() -> Dict[float, int]:
-    rows = safe_api_call(sheet.get_all_values)
+def read_sold_column() -> Counter:
+    rows = blad1.values()
     if not rows:
-        return {}
+        return Counter()
 
     header = [h.strip().lower() for h in rows[0]]
     # hitta kolumnerna – ignorera kolon, versaler och blanksteg
@@ -194,7 +488,7 @@ def read_sold_column() -> Dict[float, int]:
     if idx_num is None or idx_sold is None:
         raise RuntimeError("Hittar inte kolumnerna 'nummer:' och 'Sold:' på rad 1.")
 
-    sold: Dict[float, int] = {}
+    sold: Counter = Counter()
     for r in rows[1:]:
         if len(r) <= max(idx_num, idx_sold):
             continue
@@ -208,163 +502,300 @@ def read_sold_column() -> Dict[float, int]:
 # --------------------------------------------------------------------------- #
 #                       Shopify → nya ordrar osv …                            #
 # --------------------------------------------------------------------------- #
+ORDERS_BULK_QUERY = """
+{
+  orders(query: "created_at:>='%s'") {
+    edges { node {
+      id
+      legacyResourceId
+      createdAt
+      shippingAddress { countryCodeV2 }
+      lineItems { edges { node { title quantity customAttributes { key value } } } }
+    } }
+  }
+}"""
+
 def fetch_new_orders(domain: str, token: str, start_date: datetime):
+    try:
+        orders = fetch_orders_bulk(domain, token, start_date)
+    except (RuntimeError, requests.RequestException, KeyError, ValueError) as e:
+        print(f"[Orders] Bulk-hämtning misslyckades ({e}) – använder REST.")
+        orders = fetch_orders_rest(domain, token, start_date)
+    print(f"[Orders] Hämtade totalt {len(orders)} ordrar.")
+    return orders
+
+def fetch_orders_bulk(domain: str, token: str, start_date: datetime) -> List[dict]:
+    # GraphQL ger createdAt i UTC; REST ger butikens lokala tid, som datumen i Blad2 bygger på
+    tz = ZoneInfo(shopify_graphql(domain, token, "{ shop { ianaTimezone } }")["shop"]["ianaTimezone"])
+    by_gid: Dict[str, dict] = {}
+    # JSONL: ordrar först, därefter deras line items med __parentId.
+    # Bygg om till samma form som REST-svaret så att process_orders är oförändrad.
+    for obj in run_bulk_query(domain, token, ORDERS_BULK_QUERY % start_date.isoformat()):
+        parent = obj.get("__parentId")
+        if parent is None:
+            created = datetime.fromisoformat(obj["createdAt"].replace("Z", "+00:00"))
+            addr    = obj.get("shippingAddress")
+            by_gid[obj["id"]] = {
+                "id": int(obj["legacyResourceId"]),
+                "created_at": created.astimezone(tz).isoformat(),
+                "shipping_address": {"country_code": addr["countryCodeV2"]} if addr else None,
+                "line_items": [],
+            }
+        elif parent in by_gid:
+            by_gid[parent]["line_items"].append({
+                "title": obj["title"],
+                "quantity": obj["quantity"],
+                "properties": [{"name": a["key"], "value": a["value"]}
+                               for a in obj.get("customAttributes") or []],
+            })
+    return list(by_gid.values())
+
+ORDER_SHARDS = SHOPIFY_CONCURRENCY     # parallella tidsfönster vid lång upphämtning
+
+def fetch_orders_rest(domain: str, token: str, start_date: datetime) -> List[dict]:
+    end = datetime.utcnow()
+    if end - start_date <= timedelta(days=7):
+        orders = fetch_orders_window(domain, token, start_date, None)
+    else:
+        # Link-pagineringen är seriell, så dela upp intervallet i fönster som
+        # pagineras var för sig. Sista fönstret är öppet mot nutid.
+        step   = (end - start_date) / ORDER_SHARDS
+        bounds = [(start_date + step * i).replace(microsecond=0)
+                  for i in range(ORDER_SHARDS)] + [None]
+        with ThreadPoolExecutor(max_workers=ORDER_SHARDS) as pool:
+            parts = pool.map(lambda w: fetch_orders_window(domain, token, *w),
+                             zip(bounds, bounds[1:]))
+            by_id = {}
+            for part in parts:
+                for o in part:                  # fönstergränserna är inklusiva
+                    by_id.setdefault(o["id"], o)
+        orders = list(by_id.values())
+    return orders
+
+def fetch_orders_window(domain: str, token: str, start: datetime, end: Optional[datetime]):
     base     = f"https://{domain}/admin/api/2023-07/orders.json"
     headers  = {"X-Shopify-Access-Token": token}
-    params   = {"created_at_min": start_date.isoformat(),
+    params   = {"created_at_min": start.isoformat(),
                 "limit": 250, "status": "any"}
+    if end is not None:
+        params["created_at_max"] = end.isoformat()
     orders = []
     while True:
-        r = safe_api_call(requests.get, base, headers=headers, params=params)
+        r = shopify_get(base, headers=headers, params=params)
         if r.status_code != 200:
             raise RuntimeError(f"Shopify orders error {r.status_code}: {r.text}")
-        orders.extend(r.json().get("orders", []))
-        next_url = None
-        for part in r.headers.get("Link", "").split(","):
-            if 'rel="next"' in part:
-                next_url = part[part.find("<")+1:part.find(">")]
-                break
+        orders.extend(parse_json(r.content).get("orders", []))
+        next_url = next_page_url(r)
         if not next_url:
             break
         base, params = next_url, {}
-    print(f"[Orders] Hämtade totalt {len(orders)} ordrar.")
     return orders
 
-def process_orders(orders, sold: Dict[float, int], processed: set):
-    new_ids, sales_log, sales_log_US = [], {}, {}
+def perfume_numbers(item: dict, title: str) -> Iterator[float]:
+    # Bundle: parfymnumren ligger i properties (kan saknas/vara null), annars i titeln
+    if _BUNDLE_RE.search(title):
+        texts = (prop.get("value") for prop in item.get("properties") or ())
+    else:
+        texts = (title,)
+    for text in texts:
+        p = extract_perfume_number(text)
+        if p is not None:
+            yield p
+
+def process_orders(orders, sold: Counter, new_ids: set):
+    pending      = set(new_ids)          # varje order räknas en gång, även vid dubbletter
+    sales_log:    Counter = Counter()     # (datum, parfymnr) → antal
+    sales_log_US: Counter = Counter()
     for o in orders:
-        oid = str(o["id"])
-        if oid in processed:
+        oid = o["id"]
+        if oid not in pending:
             continue
-        date_str = datetime.strptime(
-            o["created_at"], "%Y-%m-%dT%H:%M:%S%z"
-        ).date().isoformat()
-        is_US = (o.get("shipping_address") or {}).get("country_code") == "US"
-
-        def add_sale(pnum: float, qty: int):
-            sold[pnum] = sold.get(pnum, 0) + qty
-            sales_log    .setdefault(date_str, {}).setdefault(pnum, 0)
-            sales_log[date_str][pnum] += qty
-            if is_US:
-                sales_log_US.setdefault(date_str, {}).setdefault(pnum, 0)
-                sales_log_US[date_str][pnum] += qty
+        pending.remove(oid)
+        # created_at är butikens lokala tid med offset ("2025-07-09T23:10:00+02:00");
+        # de första tio tecknen är samma datum som fromisoformat(...).date() ger
+        date_str = o["created_at"][:10]
+        try:
+            is_US = o["shipping_address"]["country_code"] == "US"
+        except (KeyError, TypeError):                   # saknas eller null
+            is_US = False
 
         for item in o["line_items"]:
-            title, qty = item["title"], item["quantity"]
-            if "sample" in title.lower():
+            title = item["title"]
+            if _SAMPLE_RE.search(title):
                 continue
-            if "Fragrance Bundle" in title:
-                for prop in item["properties"]:
-                    p = extract_perfume_number(prop["value"])
-                    if p is not None:
-                        add_sale(p, qty)
-            else:
-                p = extract_perfume_number(title)
-                if p is not None:
-                    add_sale(p, qty)
-        new_ids.append(oid)
-    return new_ids, sales_log, sales_log_US
-
-def ensure_column(sheet_obj, pnum: float) -> int:
-    headers = safe_api_call(sheet_obj.row_values, 1)
-    label   = fmt_perfume(pnum)
-    if label in headers:
-        return headers.index(label) + 1
-    safe_api_call(sheet_obj.add_cols, 1)
-    col = len(headers) + 1
-    safe_api_call(sheet_obj.update_cell, 1, col, label)
-    return col
-
-def ensure_row(sheet_obj, date_str: str, current_vals: List[List[str]]) -> int:
-    dates = [r[0] for r in current_vals]
-    if date_str in dates:
-        return dates.index(date_str) + 1
-    insert_at = sorted(dates[1:] + [date_str]).index(date_str) + 2
-    safe_api_call(sheet_obj.insert_row, [date_str], insert_at)
-    return insert_at
-
-def log_sales(log: Dict[str, Dict[float, int]], sheet_obj):
+            qty = item["quantity"]
+            for p in perfume_numbers(item, title):
+                sold[p] += qty
+                sales_log[date_str, p] += qty
+                if is_US:
+                    sales_log_US[date_str, p] += qty
+    return sales_log, sales_log_US
+
+def _text_cell(text: str) -> dict:
+    return {"userEnteredValue": {"stringValue": text}}
+
+def _number_cell(num: float) -> dict:
+    return {"userEnteredValue": {"numberValue": num}}
+
+def _value_cell(value) -> dict:
+    return _text_cell(value) if isinstance(value, str) else _number_cell(value)
+
+def _unchanged(vals: List[List[str]], cell: gspread.Cell) -> bool:
+    # Jämför mot bladets formaterade text – vid minsta skillnad skrivs cellen ändå
+    row = vals[cell.row - 1] if cell.row <= len(vals) else []
+    return cell.col <= len(row) and row[cell.col - 1] == str(cell.value)
+
+def _cells_request(sheet_obj, row_idx: int, col_idx: int, cells: List[dict]) -> dict:
+    # updateCells för en rad med celler från (row_idx, col_idx), 0-indexerat
+    return {"updateCells": {
+        "start": {"sheetId": sheet_obj.id, "rowIndex": row_idx, "columnIndex": col_idx},
+        "rows": [{"values": cells}],
+        "fields": "userEnteredValue",
+    }}
+
+# ensure_columns/ensure_rows skickar inget själva: de uppdaterar `vals` lokalt och
+# returnerar batchUpdate-requests som log_sales skickar i ett enda anrop.
+def ensure_columns(sheet_obj, vals: List[List[str]], pnums) -> List[dict]:
+    header  = vals[0]
+    missing = sorted({fmt_perfume(p) for p in pnums} - set(header), key=float)
+    if not missing:
+        return []
+    start, reqs = max(len(header), 1), []
+    extra = start + len(missing) - sheet_obj.col_count
+    if extra > 0:
+        reqs.append({"appendDimension": {"sheetId": sheet_obj.id,
+                                         "dimension": "COLUMNS", "length": extra}})
+    reqs.append(_cells_request(sheet_obj, 0, start, [_text_cell(l) for l in missing]))
+    header.extend([""] * (start - len(header)) + missing)
+    return reqs
+
+def ensure_rows(sheet_obj, vals: List[List[str]], dates) -> List[dict]:
+    existing, reqs = {r[0] for r in vals[1:] if r}, []
+    sorted_dates = sorted(r[0] if r else "" for r in vals[1:])
+    for d in sorted(set(dates) - existing):
+        pos = bisect.bisect_left(sorted_dates, d)
+        sorted_dates.insert(pos, d)
+        idx = pos + 1                                   # 0-indexerat, rad 0 är rubriken
+        reqs.append({"insertDimension": {
+            "range": {"sheetId": sheet_obj.id, "dimension": "ROWS",
+                      "startIndex": idx, "endIndex": idx + 1},
+            "inheritFromBefore": False,
+        }})
+        reqs.append(_cells_request(sheet_obj, idx, 0, [_text_cell(d)]))
+        vals.insert(idx, [d])
+    return reqs
+
+def log_sales(log: Dict[Tuple[str, float], int], cache: SheetCache) -> List[dict]:
     if not log:
-        return
-    vals, updates = safe_api_call(sheet_obj.get_all_values), []
-    for d, fdict in sorted(log.items()):
-        row = ensure_row(sheet_obj, d, vals)
-        for p, q in fdict.items():
-            col = ensure_column(sheet_obj, p)
-            cur_val = safe_api_call(sheet_obj.cell, row, col).value or "0"
-            new_val = int(cur_val) + q
-            updates.append(gspread.Cell(row, col, new_val))
-    if updates:
-        safe_api_call(sheet_obj.update_cells, updates)
-
-def update_7d_average():
-    sales_data = safe_api_call(sales_sheet.get_all_values)
+        return []
+    sheet_obj, vals = cache.ws, cache.values()
+    if not vals:
+        vals.append([])
+    # Nya kolumner, nya datumrader och alla nya summor blir batchUpdate-requests som
+    # main() skickar i ett anrop; de utförs i ordning, så värdena skrivs efter infogningen.
+    reqs  = ensure_columns(sheet_obj, vals, {p for _, p in log})
+    reqs += ensure_rows(sheet_obj, vals, {d for d, _ in log})
+
+    col_of: Dict[str, int] = {}
+    for c, h in enumerate(vals[0], 1):
+        col_of.setdefault(h, c)
+    row_of: Dict[str, int] = {}
+    for i, r in enumerate(vals[1:], 2):
+        if r:
+            row_of.setdefault(r[0], i)
+
+    # Håll den lokala kopian rektangulär (nya kolumner/rader) så den motsvarar bladet
+    width = len(vals[0])
+    for r in vals:
+        r.extend([""] * (width - len(r)))
+
+    for (d, p), q in sorted(log.items()):
+        if not q:                                       # oförändrad summa – inget att skriva
+            continue
+        row, col = row_of[d], col_of[fmt_perfume(p)]
+        new_val = int(vals[row - 1][col - 1] or 0) + q
+        vals[row - 1][col - 1] = str(new_val)
+        reqs.append(_cells_request(sheet_obj, row - 1, col - 1,
+                                   [_number_cell(new_val)]))
+    return reqs
+
+def _as_int(text: str) -> int:
+    try:
+        return int(text or 0)
+    except ValueError:
+        return 0
+
+def update_7d_average(p_to_row: Dict[float, int]) -> List[gspread.Cell]:
+    sales_data = blad2.values()            # redan uppdaterad lokalt av log_sales
     if len(sales_data) < 2:
-        return
+        return []
     headers = sales_data[0]
     today   = datetime.utcnow().date()
-    win_set = {today - timedelta(d) for d in range(7)}
-    sums: Dict[float, int] = {}
+    # Datumen i Blad2 är ISO-strängar – jämför som strängar i stället för att parsa varje rad
+    win_set = {(today - timedelta(d)).isoformat() for d in range(7)}
 
-    for row in sales_data[1:]:
-        if not row or not row[0]:
-            continue
+    # Filtrera fram fönstrets (högst 7) rader först, summera sedan kolumnvis
+    window = [row for row in sales_data[1:] if row and row[0] in win_set]
+    if not window:
+        return []
+
+    sums: Dict[float, int] = {}
+    for header, column in zip(headers[1:], list(zip(*window))[1:]):
         try:
-            date_obj = datetime.strptime(row[0], "%Y-%m-%d").date()
+            pnum = float(header)
         except ValueError:
             continue
-        if date_obj not in win_set:
-            continue
-        for idx, header in enumerate(headers[1:], 1):
-            try:
-                pnum = float(header)
-                qty  = int(row[idx] or 0)
-            except ValueError:
-                continue
-            sums[pnum] = sums.get(pnum, 0) + qty
+        sums[pnum] = sums.get(pnum, 0) + sum(map(_as_int, column))
 
     if not sums:
-        return
-    blad1_vals = safe_api_call(sheet.get_all_values)
-    p_to_row   = {float(r[0]): i for i, r in enumerate(blad1_vals, 1)
-                  if i > 1 and r and r[0].strip()}
+        return []
     cells = [
         gspread.Cell(p_to_row[p], 4, round(total/7, 2))
         for p, total in sums.items() if p in p_to_row
     ]
-    if cells:
-        safe_api_call(sheet.update_cell, 1, 4, "Snitt 7d (per dag)")
-        safe_api_call(sheet.update_cells, cells)
+    if not cells:
+        return []
+    return [gspread.Cell(1, 4, "Snitt 7d (per dag)")] + cells
 # --------------------------------------------------------------------------- #
 def main():
     print("=== OBC Lager-script (Endast Store 1) ===")
-    reset_database()
     init_tables()
 
-    inventory = fetch_shopify_inventory(SHOP_DOMAIN, SHOPIFY_TOKEN, SHOP_LOCATION_ID)
-    write_inventory_to_sheet(inventory)
-
-    sold      = read_sold_column()
-    processed = processed_order_ids()
-
     START_DATE = datetime(2025, 7, 9)
     print(f"[Orders] Hämtar ordrar från {START_DATE.date()} …")
-    orders = fetch_new_orders(SHOP_DOMAIN, SHOPIFY_TOKEN, START_DATE)
+    # Orderhämtningen går parallellt med lager-synken och Blad1-läsningen
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        orders_job = pool.submit(fetch_new_orders, SHOP_DOMAIN, SHOPIFY_TOKEN, START_DATE)
+        prefetch(blad1, blad2, blad3)
+
+        inventory = fetch_shopify_inventory(SHOP_DOMAIN, SHOPIFY_TOKEN, SHOP_LOCATION_ID)
+        inv_cells = write_inventory_to_sheet(inventory)
+
+        sold   = read_sold_column()
+        orders = orders_job.result()
 
-    new_ids, sales_log, sales_log_US = process_orders(orders, sold, processed)
-    save_processed(new_ids)
+    new_ids = save_processed([o["id"] for o in orders])
+    print(f"[Orders] {len(new_ids)} nya ordrar att behandla.")
+    sales_log, sales_log_US = process_orders(orders, sold, new_ids)
 
-    log_sales(sales_log,    sales_sheet)
-    log_sales(sales_log_US, sales_sheet_US)
+    # log_sales uppdaterar Blad2/Blad3 lokalt, så snittet nedan räknas på de nya summorna
+    reqs  = log_sales(sales_log,    blad2)
+    reqs += log_sales(sales_log_US, blad3)
 
-    blad1_vals = safe_api_call(sheet.get_all_values)
-    p_to_row   = {float(r[0]): i for i, r in enumerate(blad1_vals, 1)
-                  if i > 1 and r and r[0].strip()}
+    blad1_vals = blad1.values()
+    p_to_row   = perfume_rows(blad1_vals)
     sold_cells = [gspread.Cell(p_to_row[p], 3, q) for p, q in sold.items() if p in p_to_row]
-    if sold_cells:
-        safe_api_call(sheet.update_cells, sold_cells)
 
-    update_7d_average()
+    # Blad2/Blad3 samt lager (B), Sold (C) och snitt 7d (D) i Blad1 i ett enda skrivanrop
+    cells = inv_cells + sold_cells + update_7d_average(p_to_row)
+    cells = [c for c in cells if not _unchanged(blad1_vals, c)]
+    reqs += [_cells_request(sheet, c.row - 1, c.col - 1, [_value_cell(c.value)])
+             for c in cells]
+    if reqs:
+        safe_write_call(sheet.spreadsheet.batch_update, {"requests": reqs})
+        blad1.mark_dirty()
+        print(f"[Sheets] {len(reqs)} ändringar (varav {len(cells)} celler i Blad1) i ett anrop.")
+    close_pg_pool()
     print("✔ Klart", datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), "UTC")
 # --------------------------------------------------------------------------- #
 if __name__ == "__main__":